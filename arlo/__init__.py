@@ -1,6 +1,10 @@
 import logging
 
 from .arlo import Arlo
+from .limiter import AdaptiveLimiter
+from .recorder import StreamRecorder
+from .store import SharedStore
+from .trace import TraceRecorder, TraceReplayer
 
 
 logging.getLogger(__name__).addHandler(logging.NullHandler())
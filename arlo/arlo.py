@@ -16,11 +16,18 @@ A package for interacting with Netgear's Arlo camera system via their API.
 # See the License for the specific language governing permissions and
 # limitations under the License.
 ##
+import copy
 import functools
 import logging
+import os
+import threading
+import time
+from concurrent import futures
 
 import requests
 
+from .limiter import AdaptiveLimiter
+
 
 log = logging.getLogger(__name__)
 
@@ -35,13 +42,108 @@ def check_login(func):
     return wrapper
 
 
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """
+    Collapses concurrent calls that share a key into a single execution. The first caller
+    runs the function; callers arriving while it is in flight wait for it and receive a copy
+    of its result (or of its exception).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Runs func(*args, **kwargs) unless a call with the same key is already in flight
+
+        Args:
+            key: hashable identifying the call
+            func: callable to run
+
+        Returns:
+            The return value of func
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                # a copy per follower, so concurrent raises don't share one traceback
+                try:
+                    error = copy.copy(call.error)
+                except Exception:
+                    error = Exception(str(call.error))
+                raise error.with_traceback(None) from call.error
+            return copy.deepcopy(call.result)
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                waiters = call.waiters
+            if waiters and call.error is None:
+                # followers copy from a private snapshot so the leader's caller may mutate its result
+                call.result = copy.deepcopy(result)
+            call.done.set()
+        return result
+
+
 class Arlo(object):
-    def __init__(self, username, password):
+    # Seconds a login token and account metadata stay cached in a shared store
+    token_ttl = 3600
+    metadata_ttl = 300
+
+    def __init__(self, username, password, transport=None, store=None):
+        """
+        Args:
+            username: string Arlo account email
+            password: string Arlo account password
+            transport: callable with the signature of requests.request() used to perform every
+            HTTP request, for example a TraceRecorder or TraceReplayer. Defaults to requests.request
+            store: optional SharedStore through which processes share the login token and the
+            results of get_devices() and get_locations()
+        """
         self.username = username
         self.password = password
         self.headers = {}
         self._user_id = None
         self.base_url = 'https://arlo.netgear.com/hmsweb/'
+        self._transport = transport or requests.request
+        self._store = store
+        self._lock = threading.RLock()
+        self._inflight = SingleFlight()
+
+    def _build_headers(self, headers):
+        """
+        Merges the per-request headers with a snapshot of the session headers without
+        modifying either
+
+        Args:
+            headers: dictionary of per-request headers, or None
+
+        Returns:
+            A new dictionary of headers
+        """
+        merged = dict(headers or {})
+        with self._lock:
+            merged.update(self.headers)
+        return merged
 
     def _get_body(self, request):
         """
@@ -56,9 +158,10 @@ class Arlo(object):
         request.raise_for_status()
         return request.json()
 
-    def _get(self, url, headers={}):
+    def _get(self, url, headers=None):
         """
-        Calls requests.get() on the specified URL with the specified headers
+        Calls requests.get() on the specified URL with the specified headers. Concurrent
+        identical calls share a single in-flight request and its result.
 
         Args:
             url: string URL
@@ -67,11 +170,51 @@ class Arlo(object):
         Returns:
             JSON
         """
-        headers.update(self.headers)
-        r = requests.get(url, headers=headers)
+        key = ('GET', url, tuple(sorted(self._build_headers(headers).items())))
+        return self._inflight.do(key, self._send, 'GET', url, headers)
+
+    def _send(self, method, url, headers=None, **kwargs):
+        """
+        Performs a request with the session headers merged in. When a shared store is in use and
+        the shared token has been rejected, logs in again through the store and retries once.
+
+        Args:
+            method: string HTTP method
+            url: string URL
+            headers: dictionary of per-request headers
+            kwargs: passed on to the transport
+
+        Returns:
+            JSON
+        """
+        sent = self._build_headers(headers)
+        r = self._transport(method, url, headers=sent, **kwargs)
+        if r.status_code == 401 and self._store is not None and url != self.base_url+'login' \
+                and 'Authorization' in sent:
+            log.info('Shared token rejected, logging in again')
+            self._relogin(sent['Authorization'])
+            r = self._transport(method, url, headers=self._build_headers(headers), **kwargs)
         return self._get_body(r)
 
-    def _post(self, url, body, headers={}):
+    def _relogin(self, token):
+        """
+        Expires the shared login entry if it still holds the rejected token, then logs in
+        through the store. Comparing the entry's version means that when many processes see the
+        same 401, the entry is expired once and only one of them logs in.
+
+        Args:
+            token: the Authorization token that was rejected
+
+        Returns:
+            None
+        """
+        key = 'login:'+self.username
+        entry = self._store.get(key)
+        if entry is not None and entry.value['data']['token'] == token:
+            self._store.expire(key, entry.version)
+        self.login()
+
+    def _post(self, url, body, headers=None):
         """
         Calls requests.post() on the specified URL with the specified headers
 
@@ -83,11 +226,9 @@ class Arlo(object):
         Returns:
             JSON
         """
-        headers.update(self.headers)
-        r = requests.post(url, json=body, headers=headers)
-        return self._get_body(r)
+        return self._send('POST', url, headers, json=body)
 
-    def _put(self, url, body, headers={}):
+    def _put(self, url, body, headers=None):
         """
         Calls requests.put() on the specified URL with the specified headers
 
@@ -99,9 +240,7 @@ class Arlo(object):
         Returns:
             JSON
         """
-        headers.update(self.headers)
-        r = requests.put(url, json=body, headers=headers)
-        return self._get_body(r)
+        return self._send('PUT', url, headers, json=body)
     
     def login(self): 
         """
@@ -126,18 +265,60 @@ class Arlo(object):
               "validEmail": true
             }
         """
-        body = self._post(self.base_url+'login', {'email': self.username, 'password': self.password})
+        if self._store is None:
+            body = self._login()
+        else:
+            body = self._store.get_or_refresh('login:'+self.username, self.token_ttl, self._login)
         if body['success']:
-            self.headers = {
-                'Authorization': body['data']['token']
-            }
-            self._user_id = body['data']['userId']
+            with self._lock:
+                self.headers = {
+                    'Authorization': body['data']['token']
+                }
+                self._user_id = body['data']['userId']
+        return body
+
+    def _login(self):
+        """
+        Performs the login request behind login(). When a shared store is in use, failed
+        logins raise instead of being cached.
+
+        Returns:
+            JSON
+        """
+        body = self._post(self.base_url+'login', {'email': self.username, 'password': self.password})
+        if self._store is not None and not body['success']:
+            raise Exception('Login failed: %s' % body)
         return body
 
+    def _cached_get(self, name, url):
+        """
+        Calls _get() on the specified URL, going through the shared store if there is one. With
+        a shared store, failed responses raise instead of being cached.
+
+        Args:
+            name: string naming the cached metadata
+            url: string URL
+
+        Returns:
+            JSON
+        """
+        if self._store is None:
+            return self._get(url)
+
+        def refresh():
+            body = self._get(url)
+            if not body['success']:
+                # don't serve a failure to every process for metadata_ttl
+                raise Exception('Failed to get %s: %s' % (name, body))
+            return body
+
+        return self._store.get_or_refresh(name+':'+self.username, self.metadata_ttl, refresh)
+
     @check_login
     def logout(self):
         """
-        Logs a user out of the Arlo service
+        Logs a user out of the Arlo service. With a shared store, this revokes the token every
+        process is using, so it logs out every worker sharing the store.
         
         Args: 
 
@@ -145,8 +326,11 @@ class Arlo(object):
         """
         ret = self._put(self.base_url+'logout', {})
         if ret['success']:
-            self._user_id = None
-            self.headers = {}
+            if self._store is not None:
+                self._store.delete('login:'+self.username)
+            with self._lock:
+                self._user_id = None
+                self.headers = {}
         return ret
 
     # Configure The Schedule (Calendar) - {"from": "XXX-XXXXXXX_web","to": "XXXXXXXXXXXXX","action": "set","resource": "schedule","transId": "web!XXXXXXXX.XXXXXXXXXXXXXXXXXXXX","publishResponse": true,"properties": {"schedule": [{"modeId": "mode0","startTime": 0},{"modeId": "mode2","startTime": 28800000},{"modeId": "mode0","startTime": 64800000},{"modeId": "mode0","startTime": 86400000},{"modeId": "mode2","startTime": 115200000},{"modeId": "mode0","startTime": 151200000},{"modeId": "mode0","startTime": 172800000},{"modeId": "mode2","startTime": 201600000},{"modeId": "mode0","startTime": 237600000},{"modeId": "mode0","startTime": 259200000},{"modeId": "mode2","startTime": 288000000},{"modeId": "mode0","startTime": 324000000},{"modeId": "mode0","startTime": 345600000},{"modeId": "mode2","startTime": 374400000},{"modeId": "mode0","startTime": 410400000},{"modeId": "mode0","startTime": 432000000},{"modeId": "mode0","startTime": 518400000}]}
@@ -332,6 +516,135 @@ class Arlo(object):
                                                    "properties": {"privacyActive": active}
                                                    })
 
+    @check_login
+    def take_snapshot(self, device_id, parent_id, xcloud_id):
+        """
+        Ask the specified camera to capture a full frame snapshot. The snapshot is uploaded
+        asynchronously; once it is available, the camera's presignedFullFrameSnapshotUrl from
+        get_devices() points to it.
+
+        Args:
+            device_id: The ID of the device being targeted, obtained from get_devices()
+            parent_id: The ID of the device's parent. If this is for a Q, this is the same
+            as device_id. Otherwise, the parent_id should be that of the base station.
+            xcloud_id: The xcloud_id obtained from get_devices(). Seems to be the same across all devices
+
+        Returns:
+            JSON
+        """
+        return self._post(self.base_url+'users/devices/fullFrameSnapshot', {"from": self._user_id+"_web",
+                                                                            "to": parent_id,
+                                                                            "action": "set",
+                                                                            "resource": "cameras/"+device_id,
+                                                                            "publishResponse": "true",
+                                                                            "properties": {"activityState": "fullFrameSnapshot"}
+                                                                            }, headers={"xCloudId": xcloud_id})
+
+    @check_login
+    def get_snapshots(self, cameras, directory, timeout=30, poll_interval=1, limiter=None):
+        """
+        Capture a full frame snapshot from each of the specified cameras concurrently and save
+        them to disk as <deviceId>.jpg. Snapshots are requested in parallel, get_devices() is
+        polled until each camera reports a new snapshot URL, and each image is downloaded as soon
+        as its URL appears. Everything happens within a single deadline, and partial images are
+        removed. The baseline and the polls bypass any shared store so fresh URLs are seen.
+
+        Args:
+            cameras: A list of camera dictionaries, as returned by get_devices()
+            directory: The directory to save the snapshots to
+            timeout: seconds allowed for the whole operation
+            poll_interval: seconds between get_devices() polls
+            limiter: optional AdaptiveLimiter bounding the snapshot requests and downloads in flight
+
+        Returns:
+            A dictionary keyed by deviceId of the form
+            {"success": True, "filename": "/path/XXXXXXXXXXXXX.jpg", "error": None}
+        """
+        deadline = time.time() + timeout
+
+        def remaining():
+            return max(deadline - time.time(), 0)
+
+        def limited(func, *args):
+            if limiter is None:
+                return func(*args)
+            with limiter.slot():
+                return func(*args)
+
+        results = dict((camera['deviceId'], {'success': False, 'filename': None, 'error': None}) for camera in cameras)
+        if not cameras:
+            return results
+        # the caller's camera dictionaries may be stale, so take the baseline fresh
+        previous = dict((device.get('deviceId'), device.get('presignedFullFrameSnapshotUrl'))
+                        for device in self._get(self.base_url+'users/devices')['data'])
+
+        pool = futures.ThreadPoolExecutor(max_workers=len(cameras))
+        try:
+            snapshot_requests = dict((pool.submit(limited, self.take_snapshot, c['deviceId'], c['parentId'], c['xCloudId']), c['deviceId'])
+                             for c in cameras)
+            futures.wait(snapshot_requests, timeout=remaining())
+            pending = set()
+            for future, device_id in snapshot_requests.items():
+                if not future.done():
+                    results[device_id]['error'] = 'Timed out requesting snapshot'
+                elif future.exception() is not None:
+                    results[device_id]['error'] = str(future.exception())
+                elif not future.result().get('success'):
+                    # e.g. the camera is offline; no snapshot is coming, so don't wait for one
+                    data = future.result().get('data')
+                    message = data.get('message') if isinstance(data, dict) else None
+                    results[device_id]['error'] = message or 'Snapshot request failed: %s' % future.result()
+                else:
+                    pending.add(device_id)
+
+            downloads = {}
+            while pending and remaining() > 0:
+                time.sleep(min(poll_interval, remaining()))
+                try:
+                    devices = self._get(self.base_url+'users/devices')['data']
+                except Exception as e:
+                    log.warning('Polling for snapshots failed: %s', e)
+                    continue
+                for device in devices:
+                    device_id = device.get('deviceId')
+                    url = device.get('presignedFullFrameSnapshotUrl')
+                    if device_id in pending and url and url != previous.get(device_id):
+                        pending.discard(device_id)
+                        filename = os.path.join(directory, device_id+'.jpg')
+                        downloads[pool.submit(limited, self._download, url, filename, max(remaining(), 1), deadline)] = (device_id, filename)
+            for device_id in pending:
+                results[device_id]['error'] = 'Timed out waiting for snapshot'
+
+            futures.wait(downloads, timeout=remaining())
+            for future, (device_id, filename) in downloads.items():
+                if not future.done():
+                    # the download removes a partial file itself once it sees the deadline has
+                    # passed; one that completes in the meantime is removed when it finishes
+                    results[device_id]['error'] = 'Timed out downloading snapshot'
+                    future.add_done_callback(functools.partial(self._discard, filename))
+                elif future.exception() is not None:
+                    results[device_id]['error'] = str(future.exception())
+                else:
+                    results[device_id]['success'] = True
+                    results[device_id]['filename'] = filename
+        finally:
+            pool.shutdown(wait=False)
+        return results
+
+    def _discard(self, filename, future):
+        """
+        Removes the file written by a download that was reported as timed out
+
+        Args:
+            filename: The file the download wrote to
+            future: The download's finished future
+
+        Returns:
+            None
+        """
+        if future.exception() is None and os.path.exists(filename):
+            os.remove(filename)
+
     @check_login
     def reset(self):
     # TODO what is this?
@@ -404,7 +717,7 @@ class Arlo(object):
         Returns:
             JSON
         """
-        return self._get(self.base_url+'users/locations')
+        return self._cached_get('locations', self.base_url+'users/locations')
 
     @check_login
     def get_devices(self):
@@ -416,7 +729,7 @@ class Arlo(object):
         Returns:
             JSON
         """
-        return self._get(self.base_url+'users/devices')
+        return self._cached_get('devices', self.base_url+'users/devices')
 
     @check_login
     def get_library_metadata(self, from_date, to_date):
@@ -476,8 +789,11 @@ class Arlo(object):
         Returns:
             JSON
         """
-        body = self._post(self.base_url+'users/changePassword', {'currentPassword': self.password,'newPassword': password})
-        self.password = password
+        with self._lock:
+            current = self.password
+        body = self._post(self.base_url+'users/changePassword', {'currentPassword': current,'newPassword': password})
+        with self._lock:
+            self.password = password
         return body
 
     
@@ -561,11 +877,64 @@ class Arlo(object):
         Returns:
             None
         """
-        r = requests.get(url, stream=True)
-        r.raise_for_status()
-        with open(filename, 'wb') as fd:
-            for chunk in r.iter_content(): 
-                fd.write(chunk)
+        self._download(url, filename)
+
+    def _download(self, url, filename, timeout=None, deadline=None):
+        """
+        Streams the content at the specified URL to disk. A partially written file is removed
+        if the download fails.
+
+        Args:
+            url: string URL, usually a presigned S3 link
+            filename: The file to save the content to
+            timeout: seconds to wait on the connection, or None to wait forever
+            deadline: time.time() value by which the whole download must finish, or None
+
+        Returns:
+            None
+        """
+        r = self._transport('GET', url, stream=True, timeout=timeout)
+        try:
+            r.raise_for_status()
+            with open(filename, 'wb') as fd:
+                for chunk in r.iter_content(chunk_size=65536):
+                    if deadline is not None and time.time() > deadline:
+                        raise Exception('Download of %s timed out' % filename)
+                    fd.write(chunk)
+        except Exception:
+            if os.path.exists(filename):
+                os.remove(filename)
+            raise
+        finally:
+            r.close()
+
+    @check_login
+    def get_recordings(self, recordings, directory, limiter=None):
+        """
+        Download the specified videos concurrently and save them to disk as <name>.mp4. The
+        number of downloads in flight adapts to the observed error rate. A failed download does
+        not stop the others, and leaves no partial file behind.
+
+        Args:
+            recordings: A list of recording dictionaries, as returned by get_library()
+            directory: The directory to save the videos to
+            limiter: optional AdaptiveLimiter to use, for example one shared with other batch operations
+
+        Returns:
+            A list with one dictionary per recording, in the same order, of the form
+            {"success": True, "filename": "/path/XXXXXXXX.mp4", "error": None}
+        """
+        limiter = limiter or AdaptiveLimiter()
+        filenames = [os.path.join(directory, recording['name']+'.mp4') for recording in recordings]
+        outcomes = limiter.map(self._download, [recording['presignedContentUrl'] for recording in recordings],
+                               filenames, return_exceptions=True)
+        results = []
+        for filename, outcome in zip(filenames, outcomes):
+            if isinstance(outcome, BaseException):
+                results.append({'success': False, 'filename': None, 'error': str(outcome)})
+            else:
+                results.append({'success': True, 'filename': filename, 'error': None})
+        return results
 
     @check_login
     def stream_recording(self, device_id, parent_id):
@@ -580,6 +949,23 @@ class Arlo(object):
         Returns:
             Byte data representing the video being streamed
         """
+        r = self._open_stream(device_id, parent_id)
+        for chunk in r.iter_content():
+            yield chunk 
+
+    def _open_stream(self, device_id, parent_id, timeout=None):
+        """
+        Starts a live stream on the specified camera and opens it
+
+        Args:
+            device_id: The ID of the device being targeted, obtained from get_devices()
+            parent_id: The ID of the device's parent. If this is for a Q, this is the same
+            as device_id. Otherwise, the parent_id should be that of the base station.
+            timeout: seconds to wait on the connection, or None to wait forever
+
+        Returns:
+            A streamed requests.Response
+        """
         # TODO getting 400 as is
         body = self._post(self.base_url+'users/devices/startStream', {"from": self._user_id+"_web",
                                                                       "to": parent_id,
@@ -592,9 +978,7 @@ class Arlo(object):
                                                                           }
                                                                         #  "transId": "web!XXXXXXXX.XXXXXXXXXXXXXXXXXXXX",
                                                                       })
-        print(body['data']['url'])
-        r = requests.get(body['data']['url'], stream=True)
+        log.debug('Streaming %s from %s', device_id, body['data']['url'])
+        r = self._transport('GET', body['data']['url'], stream=True, timeout=timeout)
         r.raise_for_status()
-        for chunk in r.iter_content():
-            yield chunk 
-
+        return r
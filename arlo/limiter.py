@@ -0,0 +1,177 @@
+"""
+An adaptive concurrency limiter for bulk operations against the Arlo API and S3.
+"""
+##
+# Copyright 2016 Jeffrey D. Walter
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+import collections
+import contextlib
+import logging
+import threading
+import time
+from concurrent import futures
+
+
+log = logging.getLogger(__name__)
+
+
+class AdaptiveLimiter(object):
+    """
+    Bounds the number of operations in flight and tunes that bound at runtime using AIMD
+    (additive increase, multiplicative decrease). Every successful operation raises the limit
+    by 1/limit, so it grows by about one per round trip. A failure multiplies the limit by
+    backoff, at most once per batch of operations in flight.
+
+    Latency can optionally count as a congestion signal too: with tolerance set, an operation
+    taking more than tolerance times the smoothed minimum latency, and at least min_delta
+    seconds more than it, also backs off. Only enable this for operations of similar size;
+    whole downloads of differently sized videos will always differ widely in latency.
+
+    Usage:
+        limiter = AdaptiveLimiter()
+        with limiter.slot():
+            arlo.get_recording(url, filename)
+    """
+    def __init__(self, initial=4, minimum=1, maximum=32, backoff=0.5, tolerance=None, min_delta=0.05,
+                 on_change=None):
+        """
+        Args:
+            initial: starting limit
+            minimum: the limit never drops below this
+            maximum: the limit never rises above this
+            backoff: factor applied to the limit on failure or excessive latency
+            tolerance: latency, as a multiple of the smoothed minimum latency, considered excessive,
+            or None to back off on failures only
+            min_delta: seconds above the smoothed minimum latency an operation must also exceed to
+            be considered excessive, so jitter on very fast operations is ignored
+            on_change: optional callable invoked as on_change(old_limit, new_limit)
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.min_delta = min_delta
+        self.on_change = on_change
+        self._limit = float(initial)
+        self._inflight = 0
+        self._baseline = None
+        self._last_decrease = 0
+        self._cond = threading.Condition()
+        self.history = collections.deque([(time.time(), int(initial))], maxlen=1000)
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    @property
+    def inflight(self):
+        return self._inflight
+
+    def acquire(self):
+        """
+        Blocks until an operation may start
+        """
+        with self._cond:
+            while self._inflight >= int(self._limit):
+                self._cond.wait()
+            self._inflight += 1
+
+    def release(self, latency, error=False):
+        """
+        Marks an operation as finished and adjusts the limit
+
+        Args:
+            latency: seconds the operation took
+            error: True if the operation failed
+        """
+        now = time.time()
+        with self._cond:
+            self._inflight -= 1
+            old = int(self._limit)
+            if error or self._congested(latency):
+                # operations that started before the last decrease saw the old limit, so they
+                # shouldn't shrink it again
+                if now - latency >= self._last_decrease:
+                    self._limit = max(self.minimum, self._limit * self.backoff)
+                    self._last_decrease = now
+            else:
+                self._limit = min(self.maximum, self._limit + 1.0 / self._limit)
+            if not error:
+                if self._baseline is None or latency < self._baseline:
+                    self._baseline = latency
+                else:
+                    # let the baseline drift upwards so a one-off fast response doesn't pin it
+                    self._baseline = self._baseline * 0.95 + latency * 0.05
+            new = int(self._limit)
+            if new != old:
+                self.history.append((now, new))
+            self._cond.notify_all()
+        if new != old:
+            log.debug('Concurrency limit changed from %d to %d', old, new)
+            if self.on_change is not None:
+                self.on_change(old, new)
+
+    def _congested(self, latency):
+        if self.tolerance is None or self._baseline is None:
+            return False
+        return latency > self._baseline * self.tolerance and latency - self._baseline > self.min_delta
+
+    @contextlib.contextmanager
+    def slot(self):
+        """
+        Context manager that holds a slot for the duration of an operation; an exception
+        raised inside it counts as a failure
+        """
+        self.acquire()
+        start = time.time()
+        error = False
+        try:
+            yield
+        except Exception:
+            error = True
+            raise
+        finally:
+            # always give the slot back, even on KeyboardInterrupt or GeneratorExit
+            self.release(time.time() - start, error=error)
+
+    def map(self, func, *iterables, **kwargs):
+        """
+        Like Executor.map(), but with in-flight calls bounded by the adaptive limit. Waits for
+        every call to finish.
+
+        Args:
+            func: callable to apply
+            iterables: argument lists, as for map()
+            return_exceptions: if True, a call that raised has its exception in the returned
+            list instead of it being raised
+
+        Returns:
+            A list of results in argument order. Unless return_exceptions is True, if any call
+            raised, the first such exception is raised instead.
+        """
+        return_exceptions = kwargs.pop('return_exceptions', False)
+
+        def call(*args):
+            with self.slot():
+                return func(*args)
+
+        pool = futures.ThreadPoolExecutor(max_workers=self.maximum)
+        try:
+            results = [pool.submit(call, *args) for args in zip(*iterables)]
+        finally:
+            pool.shutdown(wait=True)
+        if return_exceptions:
+            return [future.exception() or future.result() for future in results]
+        return [future.result() for future in results]
@@ -0,0 +1,339 @@
+"""
+Continuous recording of live camera streams to time-segmented files on disk.
+"""
+##
+# Copyright 2016 Jeffrey D. Walter
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+import collections
+import csv
+import itertools
+import logging
+import os
+import struct
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+Segment = collections.namedtuple('Segment', ['start', 'duration', 'size', 'filename'])
+
+INDEX = 'index.csv'
+
+# largest ftyp/moov header kept in memory to start each fragmented MP4 segment with
+MAX_INIT_SIZE = 1 << 20
+
+
+def _mp4_boxes(chunks):
+    """
+    Splits an MP4 byte stream at its top-level box boundaries without buffering whole boxes
+
+    Args:
+        chunks: iterable of bytes
+
+    Returns:
+        A generator of (box_type, data) pairs. box_type is the box's type as a string on the
+        piece that starts a box, and None on the pieces that continue it.
+    """
+    header = b''
+    remaining = 0
+    for chunk in chunks:
+        while chunk:
+            if remaining is None:
+                # a box of size 0 runs to the end of the stream
+                yield None, chunk
+                break
+            if remaining > 0:
+                piece = chunk[:remaining]
+                chunk = chunk[len(piece):]
+                remaining -= len(piece)
+                yield None, piece
+                continue
+            # a box of size 1 carries its real size in a 64 bit field after the type
+            need = 16 if len(header) >= 8 and struct.unpack('>I', header[:4])[0] == 1 else 8
+            take = need - len(header)
+            header, chunk = header + chunk[:take], chunk[take:]
+            if len(header) < need:
+                continue
+            size, box_type = struct.unpack('>I4s', header[:8])
+            if size == 1 and len(header) < 16:
+                continue
+            if size == 1:
+                size = struct.unpack('>Q', header[8:16])[0]
+            if size != 0 and size < len(header):
+                raise ValueError('Corrupt MP4 box of size %d' % size)
+            yield box_type.decode('latin-1'), header
+            remaining = None if size == 0 else size - len(header)
+            header = b''
+
+
+class StreamRecorder(object):
+    """
+    Records the live streams of many cameras at once, each on its own thread. Every stream is
+    cut into segment files of about segment_duration seconds under <directory>/<deviceId>/,
+    named after the segment's start time in milliseconds. Each camera directory has an
+    index.csv listing the start, duration, size and filename of its segments. Dropped streams
+    are reopened straight away, with exponential backoff if reconnecting fails, and the oldest
+    segments are deleted to keep each camera under its retention limit.
+
+    Fragmented MP4 streams are only cut before a moof box, and every segment starts with the
+    stream's ftyp and moov boxes, so each .mp4 segment plays on its own. Any other stream can
+    only be cut at chunk boundaries; those segments are named .seg, and the segments of one
+    connection have to be concatenated in index order, starting from that connection's first
+    segment, to be played. Memory per stream is bounded by chunk_size plus the MP4 header.
+
+    Usage:
+        recorder = StreamRecorder(arlo, '/srv/recordings')
+        for camera in cameras:
+            recorder.add(camera['deviceId'], camera['parentId'])
+        recorder.start()
+        ...
+        recorder.stop()
+    """
+    def __init__(self, arlo, directory, segment_duration=60, retention_bytes=1 << 30, chunk_size=65536,
+                 read_timeout=10, reconnect_delay=0.5, max_reconnect_delay=30):
+        """
+        Args:
+            arlo: a logged in Arlo object
+            directory: The directory to record into
+            segment_duration: seconds of stream per segment file
+            retention_bytes: maximum bytes of segments kept per camera
+            chunk_size: bytes read from the stream at a time
+            read_timeout: seconds without data after which a stream is considered dropped
+            reconnect_delay: seconds to wait after a failed connection, doubled on each further failure
+            max_reconnect_delay: upper bound on the reconnect delay
+        """
+        self.arlo = arlo
+        self.directory = directory
+        self.segment_duration = segment_duration
+        self.retention_bytes = retention_bytes
+        self.chunk_size = chunk_size
+        self.read_timeout = read_timeout
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._cameras = {}
+        self._threads = {}
+        self._segments = {}
+        self._running = False
+
+    def add(self, device_id, parent_id):
+        """
+        Adds a camera to record, starting it right away if the recorder is running
+
+        Args:
+            device_id: The ID of the device being targeted, obtained from get_devices()
+            parent_id: The ID of the device's parent. If this is for a Q, this is the same
+            as device_id. Otherwise, the parent_id should be that of the base station.
+        """
+        with self._lock:
+            self._cameras[device_id] = parent_id
+            if self._running and device_id not in self._threads:
+                self._spawn(device_id, parent_id)
+
+    def start(self):
+        """
+        Starts recording every added camera. Raises if threads from a previous stop() that
+        timed out are still running, since they would share the camera directories.
+        """
+        with self._lock:
+            self._threads = dict((device_id, thread) for device_id, thread in self._threads.items()
+                                 if thread.is_alive())
+            if self._threads:
+                raise Exception('Recorder is still stopping: %s' % ', '.join(sorted(self._threads)))
+            self._stopping.clear()
+            self._running = True
+            for device_id, parent_id in self._cameras.items():
+                self._spawn(device_id, parent_id)
+
+    def stop(self, timeout=None):
+        """
+        Stops recording and waits for the current segments to be closed. Threads that do not
+        finish within the timeout are kept track of, and start() refuses to run until they have.
+
+        Args:
+            timeout: seconds to wait for each stream's thread, or None to wait forever
+        """
+        with self._lock:
+            self._running = False
+            self._stopping.set()
+            threads = list(self._threads.items())
+        for _, thread in threads:
+            thread.join(timeout)
+        with self._lock:
+            for device_id, thread in threads:
+                if not thread.is_alive() and self._threads.get(device_id) is thread:
+                    del self._threads[device_id]
+
+    def segments(self, device_id):
+        """
+        Lists the recorded segments of a camera, oldest first
+
+        Args:
+            device_id: The ID of the camera
+
+        Returns:
+            A list of Segment(start, duration, size, filename)
+        """
+        with self._lock:
+            segments = self._segments.get(device_id)
+            if segments is not None:
+                return list(segments)
+        return list(self._load_index(os.path.join(self.directory, device_id)))
+
+    def _spawn(self, device_id, parent_id):
+        thread = threading.Thread(target=self._record, args=(device_id, parent_id),
+                                  name='arlo-recorder-'+device_id)
+        thread.daemon = True
+        self._threads[device_id] = thread
+        thread.start()
+
+    def _load_index(self, camera_dir):
+        segments = collections.deque()
+        path = os.path.join(camera_dir, INDEX)
+        if os.path.exists(path):
+            with open(path, newline='') as fd:
+                for row in csv.reader(fd):
+                    try:
+                        start, duration, size, filename = row
+                        segment = Segment(float(start), float(duration), int(size), filename)
+                    except ValueError:
+                        # a row cut short by a crash or a concurrent append
+                        log.warning('Skipping malformed index row in %s: %s', path, row)
+                        continue
+                    if os.path.exists(os.path.join(camera_dir, filename)):
+                        segments.append(segment)
+        return segments
+
+    def _write_index(self, camera_dir, segments):
+        path = os.path.join(camera_dir, INDEX)
+        with open(path+'.tmp', 'w', newline='') as fd:
+            writer = csv.writer(fd)
+            for segment in segments:
+                writer.writerow(segment)
+        os.replace(path+'.tmp', path)
+
+    def _finish(self, camera_dir, segments, segment):
+        """
+        Adds a closed segment to the index, deleting the oldest segments if the camera is
+        over its retention limit
+        """
+        with self._lock:
+            segments.append(segment)
+            pruned = []
+            total = sum(s.size for s in segments)
+            while total > self.retention_bytes and len(segments) > 1:
+                oldest = segments.popleft()
+                total -= oldest.size
+                pruned.append(oldest)
+            remaining = list(segments)
+        for oldest in pruned:
+            try:
+                os.remove(os.path.join(camera_dir, oldest.filename))
+            except OSError as e:
+                log.warning('Could not delete segment %s: %s', oldest.filename, e)
+        if pruned:
+            self._write_index(camera_dir, remaining)
+        else:
+            with open(os.path.join(camera_dir, INDEX), 'a', newline='') as fd:
+                csv.writer(fd).writerow(segment)
+
+    def _pieces(self, chunks):
+        """
+        Splits a stream into pieces that may each start a new segment
+
+        Args:
+            chunks: iterable of bytes from the stream
+
+        Returns:
+            A tuple of (extension, init, pieces). init is the header every segment must start
+            with, and pieces is a generator of (boundary, data) pairs, where boundary is True if
+            a segment may start with data.
+        """
+        chunks = iter(chunks)
+        first = b''
+        for chunk in chunks:
+            first += chunk
+            if len(first) >= 8:
+                break
+        chunks = itertools.chain([first], chunks)
+        if first[4:8] != b'ftyp':
+            return '.seg', b'', ((True, chunk) for chunk in chunks if chunk)
+
+        boxes = _mp4_boxes(chunks)
+        init = b''
+        for box_type, data in boxes:
+            if box_type == 'moof':
+                return '.mp4', init, itertools.chain([(True, data)],
+                                                     ((box_type == 'moof', data) for box_type, data in boxes))
+            init += data
+            if len(init) > MAX_INIT_SIZE:
+                # not a fragmented MP4 we can cut; fall back to cutting at chunk boundaries
+                log.warning('MP4 header exceeds %d bytes, segments will not be playable on their own',
+                            MAX_INIT_SIZE)
+                return '.seg', b'', itertools.chain([(True, init)], ((True, data) for _, data in boxes))
+        return '.mp4', init, iter([])
+
+    def _record(self, device_id, parent_id):
+        camera_dir = os.path.join(self.directory, device_id)
+        if not os.path.isdir(camera_dir):
+            os.makedirs(camera_dir)
+        segments = self._load_index(camera_dir)
+        self._write_index(camera_dir, segments)
+        with self._lock:
+            self._segments[device_id] = segments
+        delay = self.reconnect_delay
+        last_ms = int(segments[-1].filename.split('.')[0]) if segments else 0
+        while not self._stopping.is_set():
+            received = False
+            fd = None
+            try:
+                r = self.arlo._open_stream(device_id, parent_id, timeout=self.read_timeout)
+                try:
+                    extension, init, pieces = self._pieces(r.iter_content(chunk_size=self.chunk_size))
+                    for boundary, data in pieces:
+                        if self._stopping.is_set():
+                            break
+                        received = True
+                        now = time.time()
+                        if fd is not None and boundary and now - start >= self.segment_duration:
+                            fd.close()
+                            self._finish(camera_dir, segments, Segment(start, now - start, size, filename))
+                            fd = None
+                        if fd is None:
+                            start = now
+                            # segments cut within the same millisecond still get their own file
+                            last_ms = max(int(start * 1000), last_ms + 1)
+                            filename = '%d%s' % (last_ms, extension)
+                            fd = open(os.path.join(camera_dir, filename), 'wb')
+                            fd.write(init)
+                            size = len(init)
+                        fd.write(data)
+                        size += len(data)
+                finally:
+                    if fd is not None:
+                        fd.close()
+                        self._finish(camera_dir, segments, Segment(start, time.time() - start, size, filename))
+                    r.close()
+                log.info('Stream from %s ended', device_id)
+            except Exception as e:
+                log.warning('Stream from %s dropped: %s', device_id, e)
+            # reconnect straight away after a stream that delivered data, back off otherwise
+            if received:
+                delay = self.reconnect_delay
+            else:
+                self._stopping.wait(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
@@ -0,0 +1,214 @@
+"""
+A metadata and token store shared by every process on a host.
+"""
+##
+# Copyright 2016 Jeffrey D. Walter
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+import collections
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+Entry = collections.namedtuple('Entry', ['value', 'version', 'expires'])
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS leases (
+    key TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+'''
+
+
+class SharedStore(object):
+    """
+    A versioned key/value store with TTLs, backed by a SQLite database in WAL mode so that
+    any number of processes can read it without waiting on a writer. When an entry expires,
+    get_or_refresh() lets exactly one process refresh it while the others wait for the new
+    version.
+
+    Usage:
+        store = SharedStore('/var/run/arlo.db')
+        arlo = Arlo(username, password, store=store)
+    """
+    def __init__(self, filename, lease=30, poll_interval=0.05):
+        """
+        Args:
+            filename: path of the SQLite database, created with 0600 permissions if missing
+            lease: seconds a refreshing process may hold an entry before another may take over
+            poll_interval: seconds between checks while waiting on another process's refresh
+        """
+        self.filename = filename
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self._local = threading.local()
+        os.close(os.open(filename, os.O_CREAT | os.O_RDWR, 0o600))
+        # use a throwaway connection so that a store created before forking worker processes
+        # doesn't leave an open connection for them to inherit
+        conn = sqlite3.connect(filename, timeout=lease, isolation_level=None)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(_SCHEMA)
+        finally:
+            conn.close()
+
+    def _connection(self):
+        """
+        Returns this thread's connection, opening a new one after a fork since SQLite
+        connections must not be shared across processes
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.filename, timeout=self.lease, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _owner(self):
+        return '%d:%d' % (os.getpid(), threading.current_thread().ident)
+
+    def get(self, key):
+        """
+        Reads an entry, whether or not it has expired
+
+        Args:
+            key: string key
+
+        Returns:
+            An Entry(value, version, expires) or None if the key has never been set
+        """
+        row = self._connection().execute('SELECT value, version, expires FROM entries WHERE key = ?',
+                                         (key,)).fetchone()
+        if row is None:
+            return None
+        return Entry(json.loads(row[0]), row[1], row[2])
+
+    def set(self, key, value, ttl):
+        """
+        Writes an entry, bumping its version
+
+        Args:
+            key: string key
+            value: JSON serializable value
+            ttl: seconds until the entry expires
+
+        Returns:
+            The new version number
+        """
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT version FROM entries WHERE key = ?', (key,)).fetchone()
+            version = row[0] + 1 if row else 1
+            conn.execute('INSERT OR REPLACE INTO entries (key, value, version, expires) VALUES (?, ?, ?, ?)',
+                         (key, json.dumps(value), version, time.time() + ttl))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return version
+
+    def delete(self, key):
+        """
+        Removes an entry
+
+        Args:
+            key: string key
+
+        Returns:
+            None
+        """
+        self._connection().execute('DELETE FROM entries WHERE key = ?', (key,))
+
+    def expire(self, key, version):
+        """
+        Marks an entry as expired if it is still at the specified version, so that the next
+        get_or_refresh() replaces it
+
+        Args:
+            key: string key
+            version: the version that was found to be bad
+
+        Returns:
+            True if the entry was expired, False if it had already been replaced
+        """
+        cursor = self._connection().execute('UPDATE entries SET expires = 0 WHERE key = ? AND version = ?',
+                                            (key, version))
+        return cursor.rowcount > 0
+
+    def _acquire(self, key):
+        conn = self._connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT expires FROM leases WHERE key = ?', (key,)).fetchone()
+            if row is not None and row[0] > now:
+                conn.execute('ROLLBACK')
+                return False
+            conn.execute('INSERT OR REPLACE INTO leases (key, owner, expires) VALUES (?, ?, ?)',
+                         (key, self._owner(), now + self.lease))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return True
+
+    def _release(self, key):
+        self._connection().execute('DELETE FROM leases WHERE key = ? AND owner = ?', (key, self._owner()))
+
+    def get_or_refresh(self, key, ttl, refresh):
+        """
+        Returns the value of an entry, calling refresh() to replace it if it is missing or
+        expired. Only one process refreshes a given key at a time; the others wait for the new
+        version, or take over once the refreshing process's lease runs out.
+
+        Args:
+            key: string key
+            ttl: seconds the refreshed value stays valid
+            refresh: callable returning the new JSON serializable value
+
+        Returns:
+            The entry's value
+        """
+        while True:
+            entry = self.get(key)
+            if entry is not None and entry.expires > time.time():
+                return entry.value
+            if self._acquire(key):
+                try:
+                    entry = self.get(key)
+                    if entry is not None and entry.expires > time.time():
+                        return entry.value
+                    log.debug('Refreshing %s', key)
+                    value = refresh()
+                    self.set(key, value, ttl)
+                    return value
+                finally:
+                    self._release(key)
+            time.sleep(self.poll_interval)
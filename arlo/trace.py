@@ -0,0 +1,259 @@
+"""
+Recording and offline replay of the HTTP exchanges made by an Arlo object.
+"""
+##
+# Copyright 2016 Jeffrey D. Walter
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+import collections
+import copy
+import json
+import re
+import threading
+import time
+
+import requests
+
+
+REDACTED = '<redacted>'
+SENSITIVE_HEADERS = ('authorization', 'xcloudid', 'cookie')
+SENSITIVE_FIELDS = ('password', 'currentPassword', 'newPassword', 'token', 'email')
+
+
+def _strip_query(url):
+    """
+    Drops the query string from a URL, which for presigned links holds the signature
+    """
+    return url.split('?', 1)[0]
+
+
+def _redact(value):
+    """
+    Returns a copy of a JSON value with credentials and presigned URL signatures removed
+    """
+    if isinstance(value, dict):
+        redacted = {}
+        for key, item in value.items():
+            if key in SENSITIVE_FIELDS:
+                redacted[key] = REDACTED
+            elif key.startswith('presigned') and isinstance(item, str):
+                redacted[key] = _strip_query(item)
+            else:
+                redacted[key] = _redact(item)
+        return redacted
+    if isinstance(value, list):
+        return [_redact(item) for item in value]
+    return value
+
+
+def _describe(error):
+    """
+    Describes an exception for a trace record, dropping any query strings from URLs in its message
+    """
+    return re.sub(r'\?[^\s\'"]*', '', '%s: %s' % (type(error).__name__, error))
+
+
+def _redact_headers(headers):
+    return dict((key, REDACTED if key.lower() in SENSITIVE_HEADERS else value)
+                for key, value in (headers or {}).items())
+
+
+class TraceRecorder(object):
+    """
+    A transport for Arlo that performs real requests and appends one compact JSON line per
+    exchange to a trace file. Each record holds the method, URL (without query string),
+    redacted headers and bodies, sizes, status code and timings. Requests that fail are
+    recorded too, with a status of None and the exception in error.
+
+    Usage:
+        arlo = Arlo(username, password, transport=TraceRecorder('arlo.trace'))
+    """
+    def __init__(self, filename, transport=None):
+        self.filename = filename
+        self._transport = transport or requests.request
+        self._lock = threading.Lock()
+        self._fd = open(filename, 'a')
+
+    def close(self):
+        with self._lock:
+            self._fd.close()
+
+    def _write(self, record):
+        line = json.dumps(record, separators=(',', ':'))
+        with self._lock:
+            self._fd.write(line+'\n')
+            self._fd.flush()
+
+    def __call__(self, method, url, **kwargs):
+        start = time.time()
+        body = kwargs.get('json')
+        record = {
+            'start': start,
+            'method': method.upper(),
+            'url': _strip_query(url),
+            'headers': _redact_headers(kwargs.get('headers')),
+            'request': _redact(body),
+            'request_size': len(json.dumps(body)) if body is not None else 0,
+        }
+        try:
+            r = self._transport(method, url, **kwargs)
+        except Exception as e:
+            record.update(status=None, error=_describe(e), response=None, size=0,
+                          ttfb=time.time() - start, elapsed=time.time() - start)
+            self._write(record)
+            raise
+        record['status'] = r.status_code
+        record['ttfb'] = time.time() - start
+        if kwargs.get('stream'):
+            return _RecordingResponse(r, record, self)
+        try:
+            response = r.json()
+        except ValueError:
+            response = None
+        record['response'] = _redact(response)
+        record['size'] = len(r.content)
+        record['elapsed'] = time.time() - start
+        self._write(record)
+        return r
+
+
+class _RecordingResponse(object):
+    """
+    Wraps a streamed response so the exchange is recorded exactly once: when its content has
+    been consumed, when raise_for_status() raises, or when it is closed unread
+    """
+    def __init__(self, response, record, recorder):
+        self._response = response
+        self._record = record
+        self._recorder = recorder
+        self._written = False
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def _finish(self, size, error=None):
+        if self._written:
+            return
+        self._written = True
+        self._record['response'] = None
+        self._record['size'] = size
+        self._record['elapsed'] = time.time() - self._record['start']
+        if error is not None:
+            self._record['error'] = _describe(error)
+        self._recorder._write(self._record)
+
+    def raise_for_status(self):
+        try:
+            self._response.raise_for_status()
+        except Exception as e:
+            self._finish(0, e)
+            raise
+
+    def close(self):
+        self._finish(0)
+        self._response.close()
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        size = 0
+        error = None
+        try:
+            for chunk in self._response.iter_content(chunk_size=chunk_size, decode_unicode=decode_unicode):
+                size += len(chunk)
+                yield chunk
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._finish(size, error)
+
+
+class TraceReplayer(object):
+    """
+    A transport for Arlo that serves the responses from a trace written by TraceRecorder
+    without touching the network. Responses for the same method and URL are served in the
+    order they were recorded; the last one is repeated once the others are used up. Streamed
+    downloads replay their recorded size as zero bytes, and recorded failures are raised again
+    as requests Timeout or ConnectionError exceptions.
+
+    Usage:
+        arlo = Arlo(username, password, transport=TraceReplayer('arlo.trace', speed=0))
+    """
+    def __init__(self, filename, speed=1.0):
+        """
+        Args:
+            filename: The trace file to replay
+            speed: timing scale factor. 1.0 replays at the original speed, 2.0 twice as fast,
+            and 0 without any delay
+        """
+        self.speed = speed
+        self._lock = threading.Lock()
+        self._records = collections.defaultdict(collections.deque)
+        with open(filename) as fd:
+            for line in fd:
+                if line.strip():
+                    record = json.loads(line)
+                    self._records[(record['method'], record['url'])].append(record)
+
+    def _sleep(self, seconds):
+        if self.speed and seconds > 0:
+            time.sleep(seconds / self.speed)
+
+    def __call__(self, method, url, **kwargs):
+        key = (method.upper(), _strip_query(url))
+        with self._lock:
+            queue = self._records.get(key)
+            if not queue:
+                raise requests.exceptions.ConnectionError('No recorded response for %s %s' % key)
+            record = queue.popleft() if len(queue) > 1 else queue[0]
+        self._sleep(record['ttfb'])
+        if record['status'] is None:
+            error = requests.exceptions.Timeout if 'Timeout' in record['error'] else requests.exceptions.ConnectionError
+            raise error('Recorded failure for %s %s: %s' % (key + (record['error'],)))
+        return _ReplayResponse(record, self)
+
+
+class _ReplayResponse(object):
+    def __init__(self, record, replayer):
+        self._record = record
+        self._replayer = replayer
+        self.status_code = record['status']
+        self.url = record['url']
+
+    @property
+    def content(self):
+        return b'\0' * self._record['size']
+
+    def close(self):
+        pass
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError('%s Error for url: %s' % (self.status_code, self.url), response=self)
+
+    def json(self):
+        if self._record['response'] is None:
+            raise ValueError('No JSON recorded for %s' % self.url)
+        self._replayer._sleep(self._record['elapsed'] - self._record['ttfb'])
+        return copy.deepcopy(self._record['response'])
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        chunk_size = chunk_size or 65536
+        size = self._record['size']
+        chunks = max((size + chunk_size - 1) // chunk_size, 1)
+        delay = (self._record['elapsed'] - self._record['ttfb']) / chunks
+        while size > 0:
+            self._replayer._sleep(delay)
+            n = min(chunk_size, size)
+            size -= n
+            yield b'\0' * n
@@ -1,9 +1,15 @@
 import argparse
 import datetime
+import os
+import struct
+import tempfile
+import threading
+import time
 
 import nose.tools
 
-from arlo import Arlo
+from arlo.recorder import MAX_INIT_SIZE, _mp4_boxes
+from arlo import AdaptiveLimiter, Arlo, SharedStore, StreamRecorder, TraceRecorder, TraceReplayer
 
 
 class TestArlo:
@@ -151,3 +157,235 @@ class TestArlo:
     def test_25_get_modes(self):
         pass
 
+    def test_26_concurrent_get_devices(self):
+        calls = []
+
+        class Response:
+            status_code = 200
+
+            def raise_for_status(self):
+                pass
+
+            def json(self):
+                return {'success': True, 'data': {'token': 'token', 'userId': 'XXX-XXXXXXX'}}
+
+        def transport(method, url, **kwargs):
+            calls.append(url)
+            time.sleep(1)
+            return Response()
+
+        arlo = Arlo(self.username, self.password, transport=transport)
+        arlo.login()
+        del calls[:]
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(arlo.get_devices())) for _ in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(results) == 20
+        assert all(d['success'] for d in results)
+        assert len(calls) == 1
+        results[0]['data']['extra'] = True
+        assert 'extra' not in results[1]['data']
+
+    def test_27_get_snapshots(self):
+        polls = []
+
+        class Response:
+            status_code = 200
+
+            def __init__(self, body=None, content=b''):
+                self.body = body
+                self.content = content
+
+            def raise_for_status(self):
+                pass
+
+            def json(self):
+                return self.body
+
+            def iter_content(self, chunk_size=1):
+                yield self.content
+
+            def close(self):
+                pass
+
+        def transport(method, url, json=None, **kwargs):
+            if url.endswith('login'):
+                return Response({'success': True, 'data': {'token': 'token', 'userId': 'XXX-XXXXXXX'}})
+            if url.endswith('fullFrameSnapshot'):
+                if json['to'] == 'offline':
+                    return Response({'success': False, 'data': {'message': 'Camera is offline'}})
+                return Response({'success': True})
+            if url.endswith('users/devices'):
+                polls.append(url)
+                # the first request is the baseline; camera "a" has a new snapshot from then on
+                url_a = 'https://s3/a-new.jpg' if len(polls) > 1 else 'https://s3/a-old.jpg'
+                return Response({'success': True, 'data': [
+                    {'deviceId': 'a', 'presignedFullFrameSnapshotUrl': url_a},
+                    {'deviceId': 'b', 'presignedFullFrameSnapshotUrl': 'https://s3/b-old.jpg'},
+                    {'deviceId': 'c', 'presignedFullFrameSnapshotUrl': 'https://s3/c-old.jpg'}]})
+            return Response(content=url.encode())
+
+        arlo = Arlo(self.username, self.password, transport=transport)
+        arlo.login()
+        # stale URLs in the caller's dictionaries must not count as new snapshots
+        cameras = [{'deviceId': 'a', 'parentId': 'a', 'xCloudId': 'x', 'presignedFullFrameSnapshotUrl': 'stale'},
+                   {'deviceId': 'b', 'parentId': 'b', 'xCloudId': 'x', 'presignedFullFrameSnapshotUrl': 'stale'},
+                   {'deviceId': 'c', 'parentId': 'offline', 'xCloudId': 'x'}]
+        directory = tempfile.mkdtemp()
+        d = arlo.get_snapshots(cameras, directory, timeout=2, poll_interval=0.1)
+        assert d['a']['success']
+        assert open(d['a']['filename'], 'rb').read() == b'https://s3/a-new.jpg'
+        assert d['b'] == {'success': False, 'filename': None, 'error': 'Timed out waiting for snapshot'}
+        assert d['c'] == {'success': False, 'filename': None, 'error': 'Camera is offline'}
+        assert sorted(os.listdir(directory)) == ['a.jpg']
+
+    def test_28_trace_record_and_replay(self):
+        trace = os.path.join(tempfile.mkdtemp(), 'arlo.trace')
+        recorder = TraceRecorder(trace)
+        arlo = Arlo(self.username, self.password, transport=recorder)
+        arlo.login()
+        profile = arlo.get_profile()
+        recorder.close()
+        assert self.password not in open(trace).read()
+
+        arlo = Arlo(self.username, self.password, transport=TraceReplayer(trace, speed=0))
+        assert arlo.login()['success']
+        assert arlo.get_profile() == profile
+
+    def test_29_shared_store(self):
+        store = SharedStore(os.path.join(tempfile.mkdtemp(), 'arlo.db'))
+        first = Arlo(self.username, self.password, store=store)
+        first.login()
+        devices = first.get_devices()
+        second = Arlo(self.username, self.password, store=store)
+        second.login()
+        assert second.headers == first.headers
+        assert second.get_devices() == devices
+        assert store.get('devices:'+self.username).version == 1
+
+    def test_30_adaptive_limiter(self):
+        limiter = AdaptiveLimiter(initial=2, maximum=8)
+        assert limiter.map(lambda x: x * 2, range(50)) == [x * 2 for x in range(50)]
+
+        limiter = AdaptiveLimiter(initial=2, maximum=8)
+        for _ in range(8):
+            limiter.acquire()
+            limiter.release(0.5)
+        assert limiter.limit == 4
+        limiter.acquire()
+        limiter.release(60)  # a slow operation alone is not a failure
+        assert limiter.limit == 4
+        limiter.acquire()
+        limiter.release(0.5, error=True)
+        assert limiter.limit == 2
+        assert [limit for _, limit in limiter.history][-3:] == [3, 4, 2]
+
+        limiter = AdaptiveLimiter(initial=1)
+        try:
+            with limiter.slot():
+                raise KeyboardInterrupt()
+        except KeyboardInterrupt:
+            pass
+        assert limiter.inflight == 0
+        assert limiter.map(lambda x: 1 / x, [1, 0], return_exceptions=True)[0] == 1
+
+        limiter = AdaptiveLimiter(initial=4, tolerance=2.0)
+        limiter.acquire()
+        limiter.release(0.001)
+        limiter.acquire()
+        limiter.release(0.003)  # within min_delta of the baseline
+        assert limiter.limit == 4
+        limiter.acquire()
+        limiter.release(1.0)
+        assert limiter.limit == 2
+
+    def test_31_stream_recorder(self):
+        camera = [device for device in self.devices if device['deviceType'] == 'camera'][0]
+        recorder = StreamRecorder(self.arlo, tempfile.mkdtemp(), segment_duration=5)
+        recorder.add(camera['deviceId'], camera['parentId'])
+        recorder.start()
+        time.sleep(12)
+        recorder.stop()
+        for segment in recorder.segments(camera['deviceId']):
+            assert segment.filename.endswith(('.mp4', '.seg'))
+            assert segment.size > 0
+        recorder.start()  # restarting after a completed stop is allowed
+        recorder.stop()
+
+    def test_32_stream_recorder_segments(self):
+        def box(box_type, payload, size=None):
+            if size == 1:
+                return struct.pack('>I4sQ', 1, box_type, 16 + len(payload)) + payload
+            return struct.pack('>I4s', 0 if size == 0 else 8 + len(payload), box_type) + payload
+
+        def chunked(data, n):
+            return [data[i:i + n] for i in range(0, len(data), n)]
+
+        init = box(b'ftyp', b'isom0000') + box(b'moov', b'm' * 100)
+        fragments = [box(b'moof', b'f' * 20) + box(b'mdat', bytes([i]) * 300, size=1 if i % 2 else None)
+                     for i in range(10)]
+        stream = init + b''.join(fragments)
+
+        # box headers split across chunks, 64 bit sizes, and a final box running to the end
+        tail = box(b'mdat', b'z' * 50, size=0)
+        for n in (1, 3, 7, 4096):
+            boxes = list(_mp4_boxes(chunked(stream + tail, n)))
+            assert b''.join(data for _, data in boxes) == stream + tail
+            assert [t for t, _ in boxes if t] == ['ftyp', 'moov'] + ['moof', 'mdat'] * 10 + ['mdat']
+
+        stopped = threading.Event()
+
+        class Response:
+            def __init__(self, data):
+                self.data = data
+
+            def iter_content(self, chunk_size=1):
+                return iter(chunked(self.data, 5))
+
+            def close(self):
+                pass
+
+        class FakeArlo:
+            def __init__(self, data):
+                self.data = data
+                self.opened = 0
+
+            def _open_stream(self, device_id, parent_id, timeout=None):
+                self.opened += 1
+                if self.opened > 1:
+                    stopped.set()
+                    raise IOError('stream dropped')
+                return Response(self.data)
+
+        # a segment_duration of 0 cuts before every moof
+        segment_size = len(init) + len(fragments[1])
+        directory = tempfile.mkdtemp()
+        recorder = StreamRecorder(FakeArlo(stream), directory, segment_duration=0,
+                                  retention_bytes=3 * segment_size, reconnect_delay=0.01)
+        recorder.add('camera', 'base')
+        recorder.start()
+        assert stopped.wait(5)
+        recorder.stop()
+        segments = recorder.segments('camera')
+        assert len(segments) == 3
+        camera_dir = os.path.join(directory, 'camera')
+        assert sorted(os.listdir(camera_dir)) == sorted([s.filename for s in segments] + ['index.csv'])
+        assert list(StreamRecorder(None, directory).segments('camera')) == segments
+        for segment, fragment in zip(segments, fragments[-3:]):
+            assert segment.filename.endswith('.mp4')
+            data = open(os.path.join(camera_dir, segment.filename), 'rb').read()
+            assert data == init + fragment
+            assert segment.size == len(data)
+
+        # a header too large to repeat falls back to chunk boundaries
+        big = box(b'ftyp', b'isom0000') + box(b'moov', b'm' * MAX_INIT_SIZE) + fragments[0]
+        extension, header, pieces = recorder._pieces(chunked(big, 65536))
+        assert extension == '.seg' and header == b''
+        assert b''.join(data for _, data in pieces) == big
+
+        # anything that isn't MP4 is cut at chunk boundaries too
+        extension, header, pieces = recorder._pieces([b'FLV\x01' + b'x' * 20, b'y' * 10])
+        assert extension == '.seg' and all(boundary for boundary, _ in pieces)